@@ -1,18 +1,73 @@
 import secfs.fs
+import secfs.tables
 from secfs.types import I, Principal, User, Group
 
+# Access decisions only depend on the user, the i, the inode the i currently
+# resolves to (for its encrypt and ex bits), and group membership. They are
+# memoized on exactly those, so that the several checks made for a single file
+# system operation (or FUSE access call) cost one inode load at most, and
+# repeated checks none at all.
+#
+# decisions maps (check, user, i, inode hash, groupmap version) to a decision
+decisions = {}
+# the number of decisions kept before the memo is cleared
+DECISIONS_SIZE = 65536
+
+# members indexes secfs.fs.groupmap (which maps groups to lists of users) as
+# sets. It is rebuilt, and groupmap_version bumped, whenever secfs.fs.groupmap
+# is replaced.
+members = {}
+groupmap_version = 0
+_indexed = None
+
+def _members():
+    global members, groupmap_version, _indexed
+    if secfs.fs.groupmap is not _indexed:
+        members = {g: frozenset(users) for g, users in secfs.fs.groupmap.items()}
+        groupmap_version += 1
+        _indexed = secfs.fs.groupmap
+    return members
+
+def _memoized(check, user, i, decide):
+    """
+    Returns decide(ihash) for the inode hash i currently resolves to, reusing
+    the decision made for the same check, user, i, inode and group membership
+    if there is one.
+    """
+    if not isinstance(user, User):
+        raise TypeError("{} is not a User, is a {}".format(user, type(user)))
+
+    if not isinstance(i, I):
+        raise TypeError("{} is not an I, is a {}".format(i, type(i)))
+
+    ihash = secfs.tables.resolve(i)
+    if ihash == None:
+        raise LookupError("asked to resolve i {}, but i does not exist".format(i))
+
+    _members()
+    key = (check, user, i, ihash, groupmap_version)
+    decision = decisions.get(key)
+    if decision is None:
+        if len(decisions) >= DECISIONS_SIZE:
+            decisions.clear()
+        decision = decide(ihash)
+        decisions[key] = decision
+    return decision
+
 def can_read(user, i):
     """
     Returns True if the given user can read the given i.
     """
-    #Users should be able to read unencrypted files
-    i_node = secfs.fs.get_inode(i)
-    if not i_node.encrypt:
-        return True
+    def decide(ihash):
+        #Users should be able to read unencrypted files
+        if not secfs.fs.get_inode(i).encrypt:
+            return True
 
-    #Users who own files or belong to the same group shouldbe able to read
-    #Same logic as in can_write
-    return can_write(user, i)
+        #Users who own files or belong to the same group shouldbe able to read
+        #Same logic as in can_write
+        return can_write(user, i)
+
+    return _memoized("r", user, i, decide)
 
 def can_write(user, i):
     """
@@ -29,7 +84,7 @@ def can_write(user, i):
         return False
 
     # If a group owns i, and you aren't in the group, you can't write
-    if i.p.is_group() and (i.p not in secfs.fs.groupmap or user not in secfs.fs.groupmap[i.p]):
+    if i.p.is_group() and user not in _members().get(i.p, ()):
         return False
 
     return True
@@ -38,12 +93,11 @@ def can_execute(user, i):
     """
     Returns True if the given user can execute the given i.
     """
-    if not isinstance(user, User):
-        raise TypeError("{} is not a User, is a {}".format(user, type(user)))
+    def decide(ihash):
+        if not can_read(user, i):
+            return False
 
-    if not secfs.access.can_read(user, i):
-        return False
+        # check x bits
+        return secfs.fs.get_inode(i).ex
 
-    # check x bits
-    node = secfs.fs.get_inode(i)
-    return node.ex
+    return _memoized("x", user, i, decide)
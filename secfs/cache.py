@@ -0,0 +1,174 @@
+# This file implements the client's persistent, on-disk cache. It lets a client
+# that is remounted (or restarted) pick up where it left off, rather than
+# downloading the share's entire metadata tree again on first use.
+#
+# The cache holds two kinds of things:
+#
+#  - blocks, keyed by their content hash. Blocks are immutable, and a block is
+#    only ever cached (and only ever returned from the cache) after its content
+#    has been checked against its hash, so cached blocks can be shared between
+#    shares and servers.
+#  - per-share state (e.g. the last validated VSL, and the parsed principal
+#    maps), keyed by the server and share it was built from. Such state is
+#    only a starting point: it is validated against the server on first
+#    contact, and dropped if it does not match (see secfs.tables.restore).
+#
+# The cache is disabled unless a cache directory is given, either through the
+# SECFS_CACHE_DIR environment variable or by calling setup().
+#
+# The blocks in the cache take up at most SECFS_CACHE_MAX bytes (MAX_SIZE by
+# default). Reading a cached block marks it as used by touching its mtime, and
+# when the cache grows past its limit, the least recently used blocks are
+# removed until it is down to PRUNE_TO of the limit.
+
+import os
+import pickle
+import hashlib
+import tempfile
+
+# directory is the root of the cache, or None if caching is disabled
+directory = None
+
+# share is the name under which state for the mounted share is kept
+share = None
+
+MAX_SIZE = 1024 * 1024 * 1024
+PRUNE_TO = 0.8
+max_size = MAX_SIZE
+# size is the total size of the cached blocks, as far as we know; other
+# clients may share the cache directory, so it is recomputed when pruning
+size = 0
+
+def setup(path, server_uri, share_name):
+    """
+    Enables the cache at the given directory for the given share. If path is
+    None, the SECFS_CACHE_DIR environment variable is used, and the cache is
+    left disabled if that is not set either.
+    """
+    global directory, share, max_size, size
+    if path is None:
+        path = os.environ.get("SECFS_CACHE_DIR")
+    if path is None or path == "":
+        return
+
+    directory = path
+    share = hashlib.sha224("{}\0{}".format(server_uri, share_name).encode()).hexdigest()
+    os.makedirs(os.path.join(directory, "blocks"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "state"), exist_ok=True)
+
+    max_size = int(os.environ.get("SECFS_CACHE_MAX", MAX_SIZE))
+    size = sum(sz for _, sz, _ in _blocks())
+    if size > max_size:
+        prune()
+
+def _blocks():
+    """
+    Yields (mtime, size, path) for every cached block.
+    """
+    root = os.path.join(directory, "blocks")
+    for d in os.scandir(root):
+        if not d.is_dir():
+            continue
+        for f in os.scandir(d.path):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            yield st.st_mtime, st.st_size, f.path
+
+def prune():
+    """
+    Removes the least recently used blocks until the cache takes up no more
+    than PRUNE_TO of max_size.
+    """
+    global size
+    blocks = sorted(_blocks())
+    size = sum(sz for _, sz, _ in blocks)
+    for _, sz, path in blocks:
+        if size <= max_size * PRUNE_TO:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        size -= sz
+
+def _write(path, data):
+    """
+    Atomically replaces the file at path with the given data, so that a
+    crashed client never leaves a partially written file behind.
+    """
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def _block_path(chash):
+    return os.path.join(directory, "blocks", chash[:2], chash)
+
+def get_block(chash):
+    """
+    Returns the cached block with the given content hash, or None if it is not
+    in the cache.
+    """
+    if directory is None:
+        return None
+
+    try:
+        with open(_block_path(chash), "rb") as f:
+            blob = f.read()
+    except OSError:
+        return None
+
+    if hashlib.sha224(blob).hexdigest() != chash:
+        # damaged on disk; fetch it again
+        os.unlink(_block_path(chash))
+        return None
+
+    try:
+        os.utime(_block_path(chash))
+    except OSError:
+        pass
+    return blob
+
+def put_block(chash, blob):
+    """
+    Caches the given block, whose content must already have been checked to
+    match chash.
+    """
+    global size
+    if directory is None or os.path.exists(_block_path(chash)):
+        return
+    _write(_block_path(chash), blob)
+
+    size += len(blob)
+    if size > max_size:
+        prune()
+
+def load(name):
+    """
+    Returns the cached state of the given name for the mounted share, or None
+    if there is none.
+    """
+    if directory is None:
+        return None
+
+    try:
+        with open(os.path.join(directory, "state", "{}-{}".format(share, name)), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def save(name, state):
+    """
+    Caches the given state of the given name for the mounted share.
+    """
+    if directory is None:
+        return
+    _write(os.path.join(directory, "state", "{}-{}".format(share, name)), pickle.dumps(state))
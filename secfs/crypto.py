@@ -1,15 +1,24 @@
 # This file implements the crypto parts of SecFS
+#
+# The cryptography package is only imported once it is first needed, as
+# importing it is a noticeable part of the time it takes to mount a share.
 
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.fernet import Fernet
 from secfs.types import I, Principal, User, Group
 
 keys = {}
 
+# key generation is spread over a pool of processes when at least
+# GENERATE_PARALLEL keys are needed at once (e.g. when bootstrapping a share
+# for many users) and there is more than one CPU. A 2048-bit key takes about
+# 0.1s to generate, and starting the pool about 0.3s, so fewer keys (such as
+# the two a fresh mount usually needs) are generated faster one by one.
+GENERATE_PARALLEL = 8
+GENERATE_WORKERS = 4
+
+# ciphers caches the Fernet object for each symmetric key in use, so that one
+# is not rebuilt for every block that is encrypted or decrypted
+ciphers = {}
+
 def register_keyfile(user, f):
     """
     Register the private key for the given user for use in signing/decrypting.
@@ -17,6 +26,9 @@ def register_keyfile(user, f):
     if not isinstance(user, User):
         raise TypeError("{} is not a User, is a {}".format(user, type(user)))
 
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.backends import default_backend
+
     with open(f, "rb") as key_file:
         k=key_file.read()
         keys[user] = serialization.load_pem_private_key(
@@ -25,30 +37,74 @@ def register_keyfile(user, f):
             backend=default_backend()
         )
 
+def cipher(key):
+    """
+    Return the (cached) Fernet object for the given symmetric key.
+    """
+    f = ciphers.get(key)
+    if f is None:
+        from cryptography.fernet import Fernet
+        f = Fernet(key)
+        ciphers[key] = f
+    return f
+
 def decrypt_sym(key, data):
     """
     Decrypt the given data with the given key.
     """
-    f = Fernet(key)
-    return f.decrypt(data)
+    return cipher(key).decrypt(data)
 
 def encrypt_sym(key, data):
     """
     Encrypt the given data with the given key.
     """
-    f = Fernet(key)
-    return f.encrypt(data)
+    return cipher(key).encrypt(data)
+
+def generate_symmetric_key():
+    """
+    Return a fresh key for use with encrypt_sym and decrypt_sym.
+    """
+    from cryptography.fernet import Fernet
+    return Fernet.generate_key()
+
+def _generate_keyfile(f):
+    """
+    Create a new private key, store it in the file f, and return it
+    PEM-encoded. This is run in separate processes by generate_keys.
+    """
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.backends import default_backend
+
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+
+    pem = private_key.private_bytes(
+       encoding=serialization.Encoding.PEM,
+       format=serialization.PrivateFormat.TraditionalOpenSSL,
+       encryption_algorithm=serialization.NoEncryption()
+    )
+
+    with open(f, "wb") as key_file:
+        key_file.write(pem)
+    return pem
 
 def generate_key(user):
     """
     Ensure that a private/public keypair exists in user-$uid-key.pem for the
     given user. If it does not, create one, and store the private key on disk.
-    Finally, return the user's PEM-encoded public key.
+    Finally, return the user's PEM-encoded public key. If the user's private
+    key has already been registered, it is used rather than read again.
     """
     if not isinstance(user, User):
         raise TypeError("{} is not a User, is a {}".format(user, type(user)))
 
-    from cryptography.hazmat.primitives.asymmetric import rsa
+    if user in keys:
+        return public_pem(keys[user].public_key())
+
     from cryptography.hazmat.primitives import serialization
     from cryptography.hazmat.backends import default_backend
 
@@ -56,67 +112,89 @@ def generate_key(user):
 
     import os.path
     if not os.path.isfile(f):
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
-
-        pem = private_key.private_bytes(
-           encoding=serialization.Encoding.PEM,
-           format=serialization.PrivateFormat.TraditionalOpenSSL,
-           encryption_algorithm=serialization.NoEncryption()
-        )
+        pem = _generate_keyfile(f)
+    else:
+        with open(f, "rb") as key_file:
+            pem = key_file.read()
 
-        with open(f, "wb") as key_file:
-            key_file.write(pem)
+    return public_pem(serialization.load_pem_private_key(
+        pem,
+        password=None,
+        backend=default_backend()
+    ).public_key())
 
-        public_key = private_key.public_key()
+def generate_keys(keyfiles):
+    """
+    Ensure that the private key file for each user in the given dict (mapping
+    users to file names) exists, creating the missing ones (in parallel if
+    there are many), and register all of them for use.
+    """
+    import os
+    missing = [u for u in keyfiles if not os.path.exists(keyfiles[u])]
+    workers = min(GENERATE_WORKERS, os.cpu_count() or 1, len(missing))
+    if len(missing) >= GENERATE_PARALLEL and workers > 1:
+        import multiprocessing
+        import concurrent.futures
+        # spawn, as forking a process with active connection threads is not
+        # safe
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(_generate_keyfile, [os.path.abspath(keyfiles[u]) for u in missing]))
     else:
-        with open(f, "rb") as key_file:
-            public_key = serialization.load_pem_private_key(
-                key_file.read(),
-                password=None,
-                backend=default_backend()
-            ).public_key()
+        for u in missing:
+            _generate_keyfile(keyfiles[u])
 
-    return public_key.public_bytes(
-       encoding=serialization.Encoding.PEM,
-       format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
+    for u in keyfiles:
+        register_keyfile(u, keyfiles[u])
 
 ## functionality to support the cryptographic
 ## signing and verification of VSes
 def sign(private_key, data):
-    signer = private_key.signer(
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives import hashes
+    return private_key.sign(
+        data,
         padding.PSS(
             mgf=padding.MGF1(hashes.SHA256()),
             salt_length=padding.PSS.MAX_LENGTH
         ),
         hashes.SHA256()
     )
-    signer.update(data)
-    return signer.finalize()
 
 def verify(public_key, sig, data):
-    verifier = public_key.verifier(
-        sig,
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        hashes.SHA256()
-    )
-    verifier.update(data)
-
-    #TODO figure out why verifier.verify() fails?
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.exceptions import InvalidSignature
     try:
-        b = verifier.verify()
-    except:
+        public_key.verify(
+            sig,
+            data,
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            hashes.SHA256()
+        )
+    except InvalidSignature:
         return False
-    return True # verify() worked
+    return True
+
+def load_public_key(pem):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.backends import default_backend
+    return serialization.load_pem_public_key(pem, backend=default_backend())
+
+def public_pem(public_key):
+    from cryptography.hazmat.primitives import serialization
+    return public_key.public_bytes(
+       encoding=serialization.Encoding.PEM,
+       format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
 
 def encrypt_asym(public_key, data):
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives import hashes
     # construct ciphertext with padding & return
     return public_key.encrypt(
         data,
@@ -128,6 +206,8 @@ def encrypt_asym(public_key, data):
     )
 
 def decrypt_asym(private_key, data):
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives import hashes
     # decrypt into plaintext & return
     return private_key.decrypt(
         data,
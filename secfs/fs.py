@@ -1,25 +1,36 @@
 # This file implements file system operations at the level of inodes.
 
 import time
+import contextlib
+import secfs.keys
 import secfs.crypto
 import secfs.tables
 import secfs.access
 import secfs.store.tree
 import secfs.store.block
-from secfs.store.inode import Inode
+from secfs.store.inode import Inode, BLOCK_SIZE
 from secfs.store.tree import Directory
-from cryptography.fernet import Fernet
 from secfs.types import I, Principal, User, Group, SymmetricKeyStore
 
 # usermap contains a map from user ID to their public key according to /.users
 usermap = {}
-# groupmap contains a map from group ID to the list of members according to /.groups
+# groupmap contains a map from group ID to the list of members according to /.groups.
+# it is only ever replaced, never modified in place (see secfs.access)
 groupmap = {}
 # owner is the user principal that owns the current share
 owner = None
 # root_i is the i of the root of the current share
 root_i = None
 
+# inode_cache holds the contents of recently loaded inodes by inode hash. An
+# inode hash always names the same inode, so entries never go stale. Callers
+# are free to modify the inodes get_inode returns (before storing them anew),
+# so each call hands out a fresh copy.
+inode_cache = {
+    # ihash => inode attributes
+}
+INODE_CACHE_SIZE = 4096
+
 def get_inode(i):
     """
     Shortcut for retrieving an inode given its i.
@@ -28,7 +39,47 @@ def get_inode(i):
     if ihash == None:
         raise LookupError("asked to resolve i {}, but i does not exist".format(i))
 
-    return Inode.load(ihash)
+    attrs = inode_cache.get(ihash)
+    if attrs is None:
+        node = Inode.load(ihash)
+        if node is None:
+            return None
+        if len(inode_cache) >= INODE_CACHE_SIZE:
+            inode_cache.clear()
+        inode_cache[ihash] = dict(node.__dict__, blocks=list(node.blocks))
+        return node
+
+    node = Inode()
+    node.__dict__.update(attrs)
+    node.blocks = list(node.blocks)
+    return node
+
+@contextlib.contextmanager
+def transaction(user, refresh=None):
+    """
+    Runs a batch of file system operations (create, mkdir, write, link, ...)
+    as a single transaction: the server lock is taken and the VSL refreshed
+    once, all itable changes are signed in one VS update per user, and all
+    new blocks are uploaded in bulk when the batch completes. If the batch
+    raises, none of its changes are pushed.
+
+        with secfs.fs.transaction(user):
+            for name, data in files:
+                i = secfs.fs.create(parent_i, name, user, user)
+                secfs.fs.write(user, i, 0, data)
+
+    refresh is passed on to secfs.tables.pre.
+    """
+    server = secfs.tables.server
+    version = server.lock()
+    try:
+        secfs.store.block.pre(version)
+        secfs.keys.pre()
+        secfs.tables.pre(refresh, user)
+        yield
+        secfs.tables.post(True)
+    finally:
+        server.unlock()
 
 def init(owner, users, groups):
     """
@@ -153,7 +204,7 @@ def create(parent_i, name, create_as, create_for, encrypted=False):
     Create a new file.
     See secfs.fs._create
     """
-    return _create(parent_i, name, create_as, create_for, False, encrypted=False)
+    return _create(parent_i, name, create_as, create_for, False, encrypted=encrypted)
 
 def mkdir(parent_i, name, create_as, create_for, encrypted=False):
     """
@@ -179,14 +230,11 @@ def read(read_as, i, off, size, decryption_key=None):
 
     node = get_inode(i)
     if node.encrypt and not decryption_key:
-        raise PermissionError("cannot read encrypted file {0} as {1} without decryption key".format(i, write_as))
+        # fetch the (cached) key for the file's owner from the key store
+        decryption_key = secfs.keys.key_for(read_as, i.p)
 
-    contents = node.read()
-    #Decrypt the file if necessary
-    if node.encrypt:
-        contents = secfs.crypto.decrypt_sym(decryption_key, contents)
-
-    return contents[off:off+size]
+    # only the blocks covering [off:off+size] are fetched (and decrypted)
+    return node.read(off, size, decryption_key if node.encrypt else None)
 
 def write(write_as, i, off, buf, encryption_key=None):
     """
@@ -205,30 +253,46 @@ def write(write_as, i, off, buf, encryption_key=None):
 
     node = get_inode(i)
     if node.encrypt and not encryption_key:
-        raise PermissionError("cannot write to encrypted file {0} as {1} without encryption key".format(i, write_as))
-
-
-    # TODO: this is obviously stupid -- should not get rid of blocks that haven't changed
-    bts = node.read()
-
-    #Decrpyt the data if necessary
-    if node.encrypt and len(bts) > 0:
-        #First need to decrypt the file
-        bts = secfs.crypto.decrpyt_sym(encryption_key, bts) 
-    # write also allows us to extend a file
-    if off + len(buf) > len(bts):
-        bts = bts[:off] + buf
-    else:
-        bts = bts[:off] + buf + bts[off+len(buf):]
-
+        # fetch the (cached) key for the file's owner from the key store
+        encryption_key = secfs.keys.key_for(write_as, i.p)
+
+
+    key = encryption_key if node.encrypt else None
+    end = off + len(buf)
+    size = max(node.size, end)
+
+    # only the blocks overlapping [off:off+len(buf)] change, so we read back
+    # just those, patch in buf, and leave all other blocks untouched
+    first = min(off, node.size) // BLOCK_SIZE
+    if len(node.blocks) * BLOCK_SIZE < node.size:
+        # file predates block splitting, so rewrite it from the start
+        first = 0
+    start = first * BLOCK_SIZE
+    stop = min(-(-end // BLOCK_SIZE) * BLOCK_SIZE, size)
+
+    bts = bytearray(node.read(start, stop - start, key))
+    # write also allows us to extend a file; any hole is filled with zeroes
+    if len(bts) < off - start:
+        bts.extend(bytes(off - start - len(bts)))
+    bts[off-start:end-start] = buf
+
+    # split the new content into blocks, encrypting each if necessary. blocks
+    # must be compressed before they are encrypted, as ciphertext does not
+    # compress.
+    view = memoryview(bts)
+    new_blocks = []
+    for b in range(0, len(view), BLOCK_SIZE):
+        chunk = bytes(view[b:b+BLOCK_SIZE])
+        if node.encrypt:
+            chunk = secfs.crypto.encrypt_sym(key, secfs.store.block.encode(chunk))
+            new_blocks.append(secfs.store.block.store(chunk, compress=False))
+        else:
+            new_blocks.append(secfs.store.block.store(chunk))
 
-    #Encrpyt data if necessary
-    if node.encrypt:
-        bts = secfs.crypto.encrypt_sym(encryption_key, bts)
     # update the inode
-    node.blocks = [secfs.store.block.store(bts)]
+    node.blocks = node.blocks[:first] + new_blocks + node.blocks[first+len(new_blocks):]
     node.mtime = time.time()
-    node.size = len(bts)
+    node.size = size
 
     # put new hash in tree
     new_hash = secfs.store.block.store(node.bytes())
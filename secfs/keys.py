@@ -0,0 +1,117 @@
+# This file hands out the symmetric keys used to encrypt file contents. The
+# keys live in the share's SymmetricKeyStore on the server, wrapped with each
+# user's public key. Unwrapping one takes an RSA private-key operation, so
+# every key is fetched and unwrapped at most once per session, and cached here
+# until its entry changes on the server.
+
+import base64
+import secfs.crypto
+from secfs.types import I, Principal, User, Group, SymmetricKeyStore
+
+# unwrapped maps (user, principal) to the symmetric key for files owned by
+# principal, as unwrapped with user's private key
+unwrapped = {}
+
+# sks_version is the server's key store version as of our last check
+sks_version = 0
+
+# checked is True once the server has been asked for key store changes during
+# the current file system operation
+checked = False
+
+# a server connection handle is passed to us at mount time by secfs-fuse
+server = None
+def register(_server):
+    global server
+    server = _server
+
+def pre():
+    """
+    Called before every file system operation. The server is only asked
+    whether the key store has changed once a key is actually needed.
+    """
+    global checked
+    checked = False
+
+def _refresh():
+    """
+    Drops every cached key whose key store entry has changed on the server
+    since we last checked.
+    """
+    global sks_version, checked
+    checked = True
+
+    version, changed = server.SKS_changes(sks_version)
+    changed = set(changed)
+    for user, principal in list(unwrapped.keys()):
+        if SymmetricKeyStore.entry(principal, user) in changed:
+            key = unwrapped.pop((user, principal))
+            secfs.crypto.ciphers.pop(key, None)
+    sks_version = version
+
+def push(sks):
+    """
+    Uploads the entries of the given SymmetricKeyStore that changed since it
+    was last pushed.
+    """
+    entries = sks.updates()
+    if len(entries) != 0:
+        server.update_SKS(entries)
+
+def rotate_group(group, members):
+    """
+    Assigns a fresh key to the given group, wrapped for each of the given
+    members (a dict mapping users -> public keys), and removes every other
+    user's copy of the group's key from the server. Returns the new key.
+
+    Files the group encrypted under its previous key can no longer be read
+    once it is gone, so this is only for when a member must lose access.
+    """
+    sks = SymmetricKeyStore()
+    group_key = sks.rotate_group(group, members)
+    entries = sks.updates()
+
+    # the server may hold the group's key for users this fresh store has
+    # never heard of, so ask it for every entry it has ever had
+    _, names = server.SKS_changes(0)
+    prefix = SymmetricKeyStore.entry(group, "")
+    for name in names:
+        if name.startswith(prefix) and name not in entries:
+            entries[name] = None
+    server.update_SKS(entries)
+    return group_key
+
+def key_for(user, principal):
+    """
+    Returns the symmetric key for files owned by the given principal, as made
+    available to the given user through the key store.
+    """
+    if not isinstance(user, User):
+        raise TypeError("{} is not a User, is a {}".format(user, type(user)))
+    if not isinstance(principal, Principal):
+        raise TypeError("{} is not a Principal, is a {}".format(principal, type(principal)))
+
+    if not checked:
+        _refresh()
+
+    if (user, principal) in unwrapped:
+        return unwrapped[(user, principal)]
+
+    if principal.is_user() and principal != user:
+        raise PermissionError("no key for files of {} available to {}".format(principal, user))
+    if user not in secfs.crypto.keys:
+        raise PermissionError("no private key for {}".format(user))
+
+    # fetch just the one entry we need
+    name = SymmetricKeyStore.entry(principal, user)
+    wrapped = server.retrieve_SKS([name]).get(name)
+    if wrapped is None:
+        raise PermissionError("no key for files of {} available to {}".format(principal, user))
+
+    # the RPC layer will base64 encode binary data
+    if isinstance(wrapped, dict) and "data" in wrapped:
+        wrapped = base64.b64decode(wrapped["data"])
+
+    key = secfs.crypto.decrypt_asym(secfs.crypto.keys[user], wrapped)
+    unwrapped[(user, principal)] = key
+    return key
@@ -0,0 +1,255 @@
+# This file implements SecFS's own RPC transport, as an alternative to Pyro4.
+#
+# The server side is built on asyncio, so a single process multiplexes any
+# number of client connections, and each connection may have many requests in
+# flight at once (pipelining). Messages are pickled, so binary data travels as
+# raw bytes rather than base64, and are framed by a 4-byte big-endian length.
+#
+#   request:  (request id, method name, arguments)
+#   response: (request id, True, result) or (request id, False, (type, message))
+#
+# Responses are matched to requests by id, and may be sent out of order. Only
+# the classes in ALLOWED may be instantiated when unpickling a message, so a
+# peer cannot use it to run arbitrary code.
+#
+# Servers listen on a Unix socket or a TCP port, and are addressed by URIs of
+# the form secfs+unix:///path/to/socket or secfs+tcp://host:port. connect()
+# also accepts Pyro4 URIs, for servers that still use Pyro4.
+
+import io
+import os
+import pickle
+import socket
+import struct
+import builtins
+import threading
+import secfs.types
+
+SCHEMES = ("secfs+unix://", "secfs+tcp://")
+
+# the largest message either side accepts
+MAX_FRAME = 256 * 1024 * 1024
+
+# the classes that may appear in messages
+ALLOWED = {
+    ("secfs.types", "User"): secfs.types.User,
+    ("secfs.types", "Group"): secfs.types.Group,
+    ("secfs.types", "I"): secfs.types.I,
+    ("builtins", "bytearray"): bytearray,
+    ("builtins", "set"): set,
+    ("builtins", "frozenset"): frozenset,
+}
+
+_header = struct.Struct(">I")
+
+class RemoteError(Exception):
+    """
+    Raised for an exception on the server that is not a builtin exception.
+    """
+    pass
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) in ALLOWED:
+            return ALLOWED[(module, name)]
+        raise pickle.UnpicklingError("refusing to load {}.{}".format(module, name))
+
+def _loads(data):
+    return _Unpickler(io.BytesIO(data)).load()
+
+def _frame(msg):
+    data = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(data)) + data
+
+def parse_uri(uri):
+    """
+    Returns the socket family and address of the given secfs+ URI.
+    """
+    if uri.startswith("secfs+unix://"):
+        return socket.AF_UNIX, uri[len("secfs+unix://"):]
+    if uri.startswith("secfs+tcp://"):
+        host, port = uri[len("secfs+tcp://"):].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    raise ValueError("{} is not a SecFS RPC URI".format(uri))
+
+def connect(uri, connections=4):
+    """
+    Returns a proxy for the server at the given URI, which is either a SecFS
+    RPC URI or a Pyro4 one.
+    """
+    if uri.startswith(SCHEMES):
+        return Proxy(uri, connections)
+
+    import Pyro4
+    import Pyro4.util
+    # get remote stack traces
+    import sys
+    sys.excepthook = Pyro4.util.excepthook
+    return Pyro4.Proxy(uri)
+
+class _Connection:
+    def __init__(self, family, address):
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self.next_id = 0
+
+    def _read(self, n):
+        data = self.rfile.read(n)
+        if len(data) != n:
+            raise ConnectionError("server closed the connection")
+        return data
+
+    def call_many(self, calls):
+        """
+        Sends all the given (method, args) calls at once, and then waits for
+        all of their results.
+        """
+        first = self.next_id
+        self.next_id += len(calls)
+        self.sock.sendall(b"".join(_frame((first + k, method, args)) for k, (method, args) in enumerate(calls)))
+
+        results = [None] * len(calls)
+        for _ in calls:
+            n, = _header.unpack(self._read(_header.size))
+            if n > MAX_FRAME:
+                raise ConnectionError("server sent an oversized message")
+            reqid, ok, value = _loads(self._read(n))
+            results[reqid - first] = (ok, value)
+        return results
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+class Proxy:
+    """
+    A client for a SecFS RPC server. Server methods are called as methods of
+    the proxy, as with a Pyro4.Proxy. The proxy may be used from many threads
+    at once; it keeps a pool of up to `connections` idle connections, and
+    opens more while they are all in use.
+    """
+    def __init__(self, uri, connections=4):
+        self._family, self._address = parse_uri(uri)
+        self._connections = connections
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def call(*args):
+            return self.pipeline([(name, args)])[0]
+        return call
+
+    def pipeline(self, calls):
+        """
+        Makes all the given (method, args) calls on a single connection without
+        waiting for each one to complete, and returns their results in order.
+        If any call fails, the first failure is raised once all have completed.
+        """
+        with self._lock:
+            conn = self._idle.pop() if len(self._idle) != 0 else None
+        if conn is None:
+            conn = _Connection(self._family, self._address)
+
+        try:
+            results = conn.call_many(calls)
+        except:
+            # the connection may hold half a response
+            conn.close()
+            raise
+
+        with self._lock:
+            if len(self._idle) < self._connections:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+        for ok, value in results:
+            if not ok:
+                name, msg = value
+                cls = getattr(builtins, name, None)
+                if isinstance(cls, type) and issubclass(cls, Exception):
+                    raise cls(msg)
+                raise RemoteError("{}: {}".format(name, msg))
+        return [value for _, value in results]
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+class Server:
+    """
+    Serves the public methods of obj over SecFS RPC. Methods are run on the
+    event loop, one at a time, so they should not block. The methods named in
+    blocking (e.g. one that waits for a lock) are instead run on a pool of
+    threads, so that other requests are served while they wait.
+    """
+    def __init__(self, obj, blocking=(), workers=64):
+        self.obj = obj
+        self.blocking = set(blocking)
+        self.workers = workers
+        self.pool = None
+
+    def _call(self, method, args):
+        if method.startswith("_") or not callable(getattr(type(self.obj), method, None)):
+            raise AttributeError("no such method {}".format(method))
+        return getattr(self.obj, method)(*args)
+
+    def _reply(self, reqid, method, args):
+        try:
+            return (reqid, True, self._call(method, args))
+        except Exception as e:
+            return (reqid, False, (type(e).__name__, str(e)))
+
+    async def _serve(self, reader, writer):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    n, = _header.unpack(await reader.readexactly(_header.size))
+                    if n > MAX_FRAME:
+                        break
+                    reqid, method, args = _loads(await reader.readexactly(n))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                if method in self.blocking:
+                    def done(f):
+                        if not writer.is_closing():
+                            writer.write(_frame(f.result()))
+                    fut = loop.run_in_executor(self.pool, self._reply, reqid, method, args)
+                    fut.add_done_callback(done)
+                else:
+                    writer.write(_frame(self._reply(reqid, method, args)))
+                    await writer.drain()
+        except Exception as e:
+            print("rpc: dropping connection: {}".format(e))
+        finally:
+            writer.close()
+
+    def serve(self, uri):
+        """
+        Serves requests at the given secfs+ URI forever.
+        """
+        import asyncio
+        import concurrent.futures
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        family, address = parse_uri(uri)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            loop.run_until_complete(asyncio.start_unix_server(self._serve, path=address))
+        else:
+            loop.run_until_complete(asyncio.start_server(self._serve, host=address[0], port=address[1]))
+        loop.run_forever()
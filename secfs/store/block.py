@@ -1,28 +1,223 @@
 # This file handles all interaction with the SecFS server's blob storage.
 
+import os
+import lzma
+import zlib
+import hashlib
+import secfs.cache
+
 # a server connection handle is passed to us at mount time by secfs-fuse
 server = None
 def register(_server):
     global server
     server = _server
 
-def store(blob):
+# A server may keep its blocks on a number of separate block servers (shards).
+# It then hands out their URIs, and each block is stored on and read from the
+# shard that the consistent hash ring (see secfs.store.ring) assigns it to.
+# ring is None while blocks are kept by the server itself.
+ring = None
+shard_version = 0
+shard_proxies = {
+    # uri => server connection
+}
+
+def pre(version):
     """
-    Store the given blob at the server, and return the content's hash.
+    Called at the start of every file system operation with the shard list
+    version returned by the server's lock(). The shard list is fetched again
+    if it has changed since the last operation, which cannot happen while we
+    hold the lock.
     """
-    global server
-    return server.store(blob)
+    global ring, shard_version
+    if version is None or version == shard_version:
+        return
+
+    import secfs.rpc
+    import secfs.store.ring
+    shard_version, uris = server.shards()
+    for uri in uris:
+        if uri not in shard_proxies:
+            shard_proxies[uri] = secfs.rpc.connect(uri)
+    ring = secfs.store.ring.Ring(uris) if len(uris) != 0 else None
+
+def _server_for(chash):
+    """
+    Returns the server holding the block with the given hash.
+    """
+    if ring is None:
+        return server
+    return shard_proxies[ring.lookup(chash)]
+
+# Blocks are content-addressed, so we can name them ourselves and delay
+# uploading them. Stored blocks are kept in pending until flush() is called
+# (which tables.commit() does before pushing any VS referencing them), and are
+# then uploaded in bulk. FLUSH_SIZE bounds how much is held back at a time.
+pending = {
+    # chash => block
+}
+pending_size = 0
+FLUSH_SIZE = 8 * 1024 * 1024
+
+# Blocks are compressed before they are stored whenever that pays off. Stored
+# blocks are self-describing: a block that starts with MAGIC is followed by a
+# byte naming how the rest of it is encoded, and any other block is stored
+# as-is. Uncompressed blocks that happen to start with MAGIC are stored with
+# the RAW method, so that they are never mistaken for compressed ones.
+MAGIC = b"\x00SFZ"
+RAW = b"r"
+ZLIB = b"z"
+LZMA = b"x"
+
+# blocks smaller than COMPRESS_MIN are never compressed
+COMPRESS_MIN = 256
+# LZMA compresses somewhat better than zlib, but is about half as fast even at
+# preset 0, and over ten times slower at the default preset 6, which would make
+# writes CPU-bound. Blocks are thus compressed with zlib, unless the
+# SECFS_LZMA_PRESET environment variable names an LZMA preset (0-9); blocks of
+# at least LZMA_MIN bytes that look highly compressible are then compressed
+# with LZMA instead. Blocks compressed with either are always readable.
+LZMA_PRESET = os.environ.get("SECFS_LZMA_PRESET")
+if LZMA_PRESET is not None:
+    LZMA_PRESET = int(LZMA_PRESET)
+LZMA_MIN = 16 * 1024
+# the first SAMPLE_SIZE bytes of a block are test-compressed to estimate how
+# well the block compresses; data that is already compressed or encrypted
+# barely shrinks, and is stored as-is
+SAMPLE_SIZE = 4096
+
+def encode(data, compress=True):
+    """
+    Returns data encoded for storage, compressing it if compress is set and
+    the heuristics above suggest it is worthwhile.
+    """
+    if compress and len(data) >= COMPRESS_MIN:
+        sample = data[:SAMPLE_SIZE]
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+        if ratio < 0.9:
+            if LZMA_PRESET is not None and len(data) >= LZMA_MIN and ratio < 0.5:
+                method, packed = LZMA, lzma.compress(data, preset=LZMA_PRESET)
+            else:
+                method, packed = ZLIB, zlib.compress(data, 6)
+            if len(packed) + len(MAGIC) + 1 < len(data):
+                return MAGIC + method + packed
+
+    if data[:len(MAGIC)] == MAGIC:
+        return MAGIC + RAW + data
+    return data
+
+def decode(blob):
+    """
+    Returns the original data of a block produced by encode().
+    """
+    if blob[:len(MAGIC)] != MAGIC:
+        return blob
+
+    method = blob[len(MAGIC):len(MAGIC) + 1]
+    data = memoryview(blob)[len(MAGIC) + 1:]
+    if method == ZLIB:
+        return zlib.decompress(data)
+    if method == LZMA:
+        return lzma.decompress(data)
+    if method == RAW:
+        return bytes(data)
+    raise ValueError("block is encoded with unknown method {}".format(method))
+
+def store(blob, compress=True):
+    """
+    Store the given blob at the server, and return the content's hash. The
+    blob is compressed first unless compress is False (e.g. because it has
+    already been compressed and encrypted).
+    """
+    global pending_size
+    blob = encode(blob, compress)
+    chash = hashlib.sha224(blob).hexdigest()
+    if chash not in pending:
+        pending[chash] = blob
+        pending_size += len(blob)
+        if pending_size >= FLUSH_SIZE:
+            flush()
+    return chash
+
+def flush():
+    """
+    Upload all blocks stored since the last flush.
+    """
+    global server, pending, pending_size
+    if len(pending) == 0:
+        return
+
+    chashes = list(pending.keys())
+    batches = {}
+    for chash in chashes:
+        batches.setdefault(_server_for(chash), []).append(chash)
+    for srv, batch in batches.items():
+        stored = srv.store_many([pending[chash] for chash in batch])
+        if list(stored) != batch:
+            raise ValueError("server stored blocks under unexpected hashes")
+    # we are likely to read back what we just wrote
+    for chash in chashes:
+        secfs.cache.put_block(chash, pending[chash])
+    pending = {}
+    pending_size = 0
+
+def fetch_many(chashes):
+    """
+    Fetches the blocks with the given hashes from the server(s) as they are
+    stored, i.e. without checking, caching or decoding them. Returns a list
+    holding each block, or None for blocks the server does not have.
+    """
+    import secfs.rpc
+    batches = {}
+    for k, chash in enumerate(chashes):
+        batches.setdefault(_server_for(chash), []).append(k)
+
+    blobs = [None] * len(chashes)
+    for srv, ks in batches.items():
+        if isinstance(srv, secfs.rpc.Proxy):
+            # all reads are sent before waiting for any of them
+            got = srv.pipeline([("read", (chashes[k],)) for k in ks])
+        else:
+            got = [srv.read(chashes[k]) for k in ks]
+        for k, blob in zip(ks, got):
+            # the RPC layer will base64 encode binary data
+            if isinstance(blob, dict) and "data" in blob:
+                import base64
+                blob = base64.b64decode(blob["data"])
+            blobs[k] = blob
+    return blobs
+
+def discard():
+    """
+    Drop all blocks stored since the last flush without uploading them.
+    """
+    global pending, pending_size
+    pending = {}
+    pending_size = 0
 
 def load(chash):
     """
-    Load the blob with the given content hash from the server.
+    Load the blob with the given content hash from the local cache, or from
+    the server if it is not cached.
     """
-    global server
-    blob = server.read(chash)
+    if chash in pending:
+        return decode(pending[chash])
+
+    blob = secfs.cache.get_block(chash)
+    if blob is not None:
+        return decode(blob)
+
+    blob = _server_for(chash).read(chash)
+    if blob is None:
+        return None
 
     # the RPC layer will base64 encode binary data
-    if "data" in blob:
+    if isinstance(blob, dict) and "data" in blob:
         import base64
         blob = base64.b64decode(blob["data"])
 
-    return blob
+    if hashlib.sha224(blob).hexdigest() != chash:
+        raise ValueError("server returned a block that does not match its hash {}".format(chash))
+    secfs.cache.put_block(chash, blob)
+
+    return decode(blob)
@@ -0,0 +1,287 @@
+# This file implements garbage collection of the SecFS server's block storage.
+#
+# Every write leaves the previous versions of the file's blocks, its inode and
+# the itable nodes on the path to it behind on the server. The collector finds
+# the blocks that can still be reached from the roots of the file system (the
+# itables named by current VS's), and deletes the rest. It runs incrementally,
+# a bounded number of blocks at a time, so that it never holds up the server's
+# store and read calls for long.
+#
+# A client may still be working from a VSL it fetched a little while ago, so
+# two kinds of blocks are always kept:
+#
+#  - blocks stored (or re-stored) within the last `retention` seconds, which
+#    also covers everything stored while a collection is in progress, and
+#  - blocks reachable from VS's that were replaced within the last
+#    `retention` seconds.
+#
+# When the server spreads its blocks over shards (see bin/secfs-rebalance), the
+# collector marks by reading blocks from the shards the ring assigns them to,
+# and sweeps each shard by listing its blocks and asking it to delete the
+# unreachable ones. Each shard checks when it last stored a block itself
+# before deleting it, so the retention window holds for blocks that clients
+# stored on the shard directly. A collection whose marking overlaps a change
+# of the shard list is abandoned and started over, as blocks may have moved
+# between shards under it.
+
+import time
+import pickle
+import secfs.types
+import secfs.store.block
+
+# the size of a raw SHA-224 block hash; see secfs.tables.ItableNode
+DIGEST_SIZE = 28
+_NO_DIGEST = bytes(DIGEST_SIZE)
+
+class _Unpickler(pickle.Unpickler):
+    """
+    Blocks are written by clients, so only the classes that legitimately appear
+    in SecFS metadata may be instantiated while parsing them.
+    """
+    def find_class(self, module, name):
+        if module == "secfs.types" and name in ("User", "Group", "I", "VS"):
+            return getattr(secfs.types, name)
+        raise pickle.UnpicklingError("refusing to load {}.{}".format(module, name))
+
+def _loads(blob):
+    import io
+    return _Unpickler(io.BytesIO(blob)).load()
+
+def _slot_values(slots):
+    """
+    Yields the values held in the slots of an itable node, in either its
+    packed or its dict form.
+    """
+    if isinstance(slots, dict):
+        yield from slots.values()
+        return
+    for off in range(0, len(slots), DIGEST_SIZE):
+        d = slots[off:off + DIGEST_SIZE]
+        if d != _NO_DIGEST:
+            yield d.hex()
+
+def refs(kind, blob):
+    """
+    Returns the (kind, chash) pairs referenced by the given block, which is of
+    the given kind ("itable", "node", "inode" or "data").
+    """
+    if kind == "data":
+        return []
+
+    data = _loads(secfs.store.block.decode(blob))
+    if kind == "inode":
+        return [("data", b) for b in data.get("blocks", [])]
+
+    if isinstance(data, dict):
+        # itable stored as a single mapping before itables were trees
+        return [("inode", v) for v in data.values() if isinstance(v, str)]
+
+    if kind == "itable":
+        _, depth, slots = data
+    else:
+        depth, slots = data
+
+    if depth > 0:
+        return [("node", v) for v in _slot_values(slots)]
+    # group itables map to is rather than to inode hashes
+    return [("inode", v) for v in _slot_values(slots) if isinstance(v, str)]
+
+def _read_many(proxy, chashes):
+    import secfs.rpc
+    if isinstance(proxy, secfs.rpc.Proxy):
+        return proxy.pipeline([("read", (chash,)) for chash in chashes])
+    return [proxy.read(chash) for chash in chashes]
+
+class Collector:
+    """
+    An incremental mark-and-sweep collector for the blocks of a SecFSRPC
+    server, or of its shards if it has any. Call step() repeatedly; each call
+    does a bounded amount of work, and a new collection is started once the
+    previous one has finished.
+    """
+    def __init__(self, server, lock, retention=600, batch=1000):
+        self.server = server
+        # held by the server while storing a block, so that a block cannot be
+        # re-stored between us deciding to delete it and deleting it
+        self.lock = lock
+        self.retention = retention
+        self.batch = batch
+
+        self.phase = "idle"
+        self.started = None
+        self.queue = []
+        self.marked = set()
+        self.candidates = []
+        self.freed = 0
+
+        # the shard list the current collection runs against
+        self.shard_version = None
+        self.ring = None
+        self.proxies = {
+            # uri => shard connection
+        }
+
+    def _roots(self, now):
+        """
+        Returns the itable handles named by the current VS's, and by every VS
+        replaced within the retention window.
+        """
+        history = self.server.vsl_history
+        while len(history) != 0 and history[0][0] < now - self.retention:
+            history.pop(0)
+
+        blobs = list(self.server.vsl.values()) + [vs for _, vs in list(history)]
+        roots = []
+        for blob in blobs:
+            vs = _loads(blob)
+            if vs.ihandle is not None:
+                roots.append(("itable", vs.ihandle))
+            for ihandle in vs.group_ihandle.values():
+                roots.append(("itable", ihandle))
+        return roots
+
+    def _proxy(self, uri):
+        if uri not in self.proxies:
+            import secfs.rpc
+            self.proxies[uri] = secfs.rpc.connect(uri)
+        return self.proxies[uri]
+
+    def _fetch(self, chashes):
+        """
+        Returns the blocks with the given hashes, or None for those that do
+        not exist, from wherever the current collection's shard list puts them.
+        """
+        if self.ring is None:
+            return [self.server.blocks.get(chash) for chash in chashes]
+
+        by_shard = {}
+        for k, chash in enumerate(chashes):
+            by_shard.setdefault(self.ring.lookup(chash), []).append(k)
+        blobs = [None] * len(chashes)
+        for uri, ks in by_shard.items():
+            for k, blob in zip(ks, _read_many(self._proxy(uri), [chashes[k] for k in ks])):
+                blobs[k] = blob
+        return blobs
+
+    def _candidates(self):
+        """
+        Returns (shard uri, chash) for every block that exists now, with a
+        shard uri of None for blocks kept by the server itself.
+        """
+        if self.ring is None:
+            # this is only a copy of the keys, so the lock is held briefly;
+            # blocks stored since we started are skipped by the sweep, which
+            # checks stored_at under the lock for every block anyway
+            with self.lock:
+                return [(None, chash) for chash in self.server.blocks]
+
+        candidates = []
+        for uri in self.ring.shards:
+            candidates.extend((uri, chash) for chash in self._proxy(uri).list_blocks())
+        return candidates
+
+    def step(self):
+        """
+        Does one bounded unit of collection work. Returns True when a full
+        collection has just completed.
+        """
+        if self.phase == "idle":
+            import secfs.store.ring
+            self.started = time.time()
+            self.shard_version = self.server.shard_version
+            uris = list(self.server.shard_uris)
+            self.ring = secfs.store.ring.Ring(uris) if len(uris) != 0 else None
+            self.queue = self._roots(self.started)
+            self.marked = set()
+            self.freed = 0
+            self.phase = "mark"
+            return False
+
+        if self.phase == "mark":
+            if len(self.queue) == 0:
+                self.candidates = self._candidates()
+                self.phase = "sweep"
+                return False
+
+            batch = []
+            while len(self.queue) != 0 and len(batch) < self.batch:
+                kind, chash = self.queue.pop()
+                if chash in self.marked:
+                    continue
+                self.marked.add(chash)
+                batch.append((kind, chash))
+
+            blobs = self._fetch([chash for _, chash in batch])
+            if self.server.shard_version != self.shard_version:
+                # blocks may have moved to another shard (and been deleted
+                # from the one we read) while we were reading
+                print("gc: shard list changed, starting over")
+                self.abandon()
+                return False
+
+            for (kind, chash), blob in zip(batch, blobs):
+                if blob is None:
+                    continue
+                try:
+                    self.queue.extend(refs(kind, blob))
+                except Exception as e:
+                    # we cannot tell what a reachable block we cannot parse
+                    # refers to, so sweeping now could delete live blocks
+                    raise ValueError("cannot parse {} block {}: {}".format(kind, chash, e))
+            return False
+
+        # sweep
+        if len(self.candidates) == 0:
+            print("gc: freed {} blocks, {} reachable".format(self.freed, len(self.marked)))
+            self.phase = "idle"
+            self.marked = set()
+            return True
+
+        cutoff = self.started - self.retention
+        garbage = {}
+        for _ in range(self.batch):
+            if len(self.candidates) == 0:
+                break
+            uri, chash = self.candidates.pop()
+            if chash in self.marked:
+                continue
+            if uri is not None:
+                garbage.setdefault(uri, []).append(chash)
+                continue
+            with self.lock:
+                if self.server.stored_at.get(chash, 0) >= cutoff:
+                    continue
+                self.server.blocks.pop(chash, None)
+                self.server.stored_at.pop(chash, None)
+            self.freed += 1
+
+        for uri, chashes in garbage.items():
+            # shards are told how old a block must be rather than when it
+            # must have been stored, so their clocks need not agree with ours
+            self.freed += self._proxy(uri).collect_blocks(chashes, time.time() - cutoff)
+        return False
+
+    def abandon(self):
+        """
+        Drops the collection in progress, if any, without sweeping.
+        """
+        self.phase = "idle"
+        self.queue = []
+        self.marked = set()
+        self.candidates = []
+
+    def run(self, interval, pause=0.01):
+        """
+        Runs a full collection every interval seconds, sleeping for pause
+        seconds between steps so that requests are served in between. A
+        collection that fails (e.g. because a shard is unreachable) is
+        abandoned, and tried again at the next interval.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                while not self.step():
+                    time.sleep(pause)
+            except Exception as e:
+                print("gc: collection failed, will retry: {}: {}".format(type(e).__name__, e))
+                self.abandon()
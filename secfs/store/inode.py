@@ -2,6 +2,11 @@ import pickle
 import secfs.store.block
 import secfs.crypto
 
+# File content is split into blocks of BLOCK_SIZE bytes. Every block except the
+# last one is full, so the blocks covering a given byte range can be found
+# from the offset alone without loading anything.
+BLOCK_SIZE = 64 * 1024
+
 class Inode:
     def __init__(self, encrypt=False):
         self.size = 0
@@ -24,11 +29,44 @@ class Inode:
         n.__dict__.update(pickle.loads(d))
         return n
 
-    def read(self):
+    def read(self, off=0, size=None, key=None):
         """
-        Reads the block content of this inode.
+        Reads size bytes of block content of this inode starting at off, or
+        everything from off onwards if size is None. If key is given, each
+        block is decrypted with it (and then decompressed) after loading.
+
+        Only the blocks covering the requested range are loaded, and they are
+        sliced through memoryviews, so the returned bytestring is the only
+        copy made of the file data.
         """
-        return b"".join([secfs.store.block.load(b) for b in self.blocks])
+        if size is not None and size <= 0:
+            return b""
+
+        # a single block may be larger than BLOCK_SIZE for directories and
+        # for files written before content was split into blocks
+        first = min(off // BLOCK_SIZE, max(len(self.blocks) - 1, 0))
+        last = len(self.blocks)
+        if size is not None:
+            last = min((off + size - 1) // BLOCK_SIZE + 1, last)
+
+        parts = []
+        pos = first * BLOCK_SIZE # file offset of the current block
+        for b in self.blocks[first:last]:
+            data = secfs.store.block.load(b)
+            if key is not None:
+                # encrypted blocks are compressed before being encrypted
+                data = secfs.store.block.decode(secfs.crypto.decrypt_sym(key, data))
+
+            view = memoryview(data)
+            start = max(off - pos, 0)
+            end = len(view)
+            if size is not None:
+                end = min(off + size - pos, end)
+            if start < end:
+                parts.append(view[start:end])
+            pos += len(view)
+
+        return b"".join(parts)
 
     def bytes(self):
         """
@@ -0,0 +1,61 @@
+# This file implements the consistent hash ring used to spread blocks over the
+# block servers of a sharded SecFS server.
+#
+# Every shard is placed at VNODES pseudo-random points on a ring of 64-bit
+# positions, and a block belongs to the shard at the first point at or after
+# the block's position (the first 64 bits of its content hash). Adding a shard
+# to a ring of N shards thus only moves about 1/(N+1) of the blocks (all of
+# them to the new shard), and removing one only moves that shard's blocks.
+
+import bisect
+import hashlib
+
+# the number of points each shard has on the ring; more points spread blocks
+# more evenly
+VNODES = 128
+
+def _position(chash):
+    return int(chash[:16], 16)
+
+class Ring:
+    """
+    A consistent hash ring mapping block hashes to shard names (e.g. the URIs
+    of block servers).
+    """
+    def __init__(self, shards=(), vnodes=VNODES):
+        self.vnodes = vnodes
+        self.shards = []
+        self.points = [] # sorted ring positions
+        self.owners = [] # shard at each position in points
+        for shard in shards:
+            self.add(shard)
+
+    def _points(self, shard):
+        for k in range(self.vnodes):
+            yield _position(hashlib.sha224("{}#{}".format(shard, k).encode()).hexdigest())
+
+    def add(self, shard):
+        if shard in self.shards:
+            return
+        self.shards.append(shard)
+        for p in self._points(shard):
+            at = bisect.bisect_left(self.points, p)
+            self.points.insert(at, p)
+            self.owners.insert(at, shard)
+
+    def remove(self, shard):
+        if shard not in self.shards:
+            return
+        self.shards.remove(shard)
+        keep = [(p, s) for p, s in zip(self.points, self.owners) if s != shard]
+        self.points = [p for p, _ in keep]
+        self.owners = [s for _, s in keep]
+
+    def lookup(self, chash):
+        """
+        Returns the shard responsible for the block with the given hash.
+        """
+        if len(self.points) == 0:
+            raise LookupError("ring has no shards")
+        at = bisect.bisect_left(self.points, _position(chash))
+        return self.owners[at % len(self.owners)]
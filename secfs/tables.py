@@ -4,19 +4,49 @@
 # NOTE: an ihandle is the hash of a principal's itable, which holds that
 # principal's mapping from inumbers (the second part of an i) to inode hashes.
 
+import time
 import base64
 import pickle
+import hashlib
 import sys
 import secfs.store
 import secfs.fs
+import secfs.cache
+import secfs.crypto
 from secfs.types import I, Principal, User, Group, VS, VSL
 
 # current_itables represents the current view of the file system's itables
 current_itables = {}
 
-# The VSL will be downloaded from the server, modified and sent back to support
-# multiple users
+# The VSL is kept across operations. Before each operation, only the VS's that
+# changed on the server since vsl_version are downloaded, and after it, only the
+# VS's we changed are sent back
 vsl = None
+vsl_version = 0
+
+# loaded maps each principal to the ihandle its current itable was loaded from
+loaded = {}
+
+# pending maps each user to the set of principals whose itables they have
+# modified since the last commit(). Modified itables are only stored, and a
+# VS signed for them, when the operation (or transaction) commits.
+pending = {}
+
+# verified maps each user to the digest of their latest VS whose signature has
+# been checked, so that only VS's that have changed since are verified again
+verified = {}
+
+# unverified holds VS's fetched from the server whose signatures have not yet
+# been checked, because the signer's public key was not known at the time
+unverified = []
+
+# saved_version is the VSL version last written to the on-disk cache, and
+# saved_at when. Writing the VSL out takes time proportional to the number of
+# users, so it is written at most every SAVE_INTERVAL seconds, and when the
+# share is unmounted.
+saved_version = None
+saved_at = 0
+SAVE_INTERVAL = 30
 
 # a server connection handle is passed to us at mount time by secfs-fuse
 server = None
@@ -24,41 +54,173 @@ def register(_server):
     global server
     server = _server
 
+def verify(strict):
+    """
+    Checks the signatures of all VS's in unverified against their signers'
+    public keys in secfs.fs.usermap. VS's whose signer is not (yet) known are
+    left in unverified, unless strict is set, in which case they are rejected
+    like any VS with a bad signature.
+    """
+    global unverified
+
+    todo = []
+    unknown = []
+    for vs in unverified:
+        if vs.signature is None:
+            raise PermissionError("VS for {} is not signed".format(vs.user))
+        digest = _digest(vs)
+        if verified.get(vs.user) == digest:
+            continue
+        if vs.user not in secfs.fs.usermap:
+            unknown.append(vs)
+            continue
+        todo.append((vs, digest))
+
+    if strict and len(unknown) != 0:
+        _reset()
+        raise PermissionError("VS for {} is signed by an unknown user".format(unknown[0].user))
+
+    # a signature takes tens of microseconds to check, so even a share with
+    # thousands of users is verified faster than a pool of processes starts
+    for vs, digest in todo:
+        if not secfs.crypto.verify(secfs.fs.usermap[vs.user], vs.signature, vs.signed_bytes()):
+            _reset()
+            raise PermissionError("VS for {} has an invalid signature".format(vs.user))
+        verified[vs.user] = digest
+
+    unverified = unknown
+
+def _reset():
+    """
+    Forgets all cached VSL and itable state, so that the next call to pre()
+    fetches everything from the server.
+    """
+    global vsl, vsl_version
+    vsl = None
+    vsl_version = 0
+    current_itables.clear()
+    loaded.clear()
+    pending.clear()
+    unverified.clear()
+    secfs.store.block.discard()
+
+def _decode_VSes(changed):
+    """
+    Unpickles the VS's in a VSL as returned by the server.
+    """
+    vses = []
+    for blob in changed.values():
+        # the RPC layer will base64 encode binary data
+        if isinstance(blob, dict) and "data" in blob:
+            blob = base64.b64decode(blob["data"])
+        vses.append(pickle.loads(blob))
+    return vses
+
+def _digest(vs):
+    return hashlib.sha224(vs.signed_bytes() + vs.signature).hexdigest()
+
+def save(force=False):
+    """
+    Writes the current (validated) VSL to the on-disk cache, if it has
+    changed since it was last written, and either force is set or it was last
+    written more than SAVE_INTERVAL seconds ago.
+    """
+    global saved_version, saved_at
+    if secfs.cache.directory is None or vsl is None or len(unverified) != 0 or vsl_version == saved_version:
+        return
+    if not force and time.time() - saved_at < SAVE_INTERVAL:
+        return
+
+    vses = dict(vsl.vsl)
+    secfs.cache.save("vsl", {
+        "root": secfs.fs.root_i,
+        "version": vsl_version,
+        "vsl": vses,
+        "verified": {u: d for u, d in verified.items() if u in vses and d == _digest(vses[u])},
+    })
+    saved_version = vsl_version
+    saved_at = time.time()
+
+def restore(root):
+    """
+    Called on first contact with the server. If the on-disk cache holds a VSL
+    for the share rooted at root, it is checked against the server's current
+    VSL: every cached VS must be dominated by the server's VS for the same
+    user. If so, the server's VSL is adopted, and signatures that were already
+    verified in an earlier session are not checked again. Otherwise, the
+    server has rolled back (or is not the server the cache was built from),
+    and the cached state is ignored.
+    """
+    global vsl, vsl_version, saved_version
+    state = secfs.cache.load("vsl")
+    if state is None or state["root"] != root:
+        return
+
+    version, changed = server.retrieve_VSL(0)
+    vses = _decode_VSes(changed)
+    current = {vs.user: vs for vs in vses}
+    for u, vs in state["vsl"].items():
+        if u not in current or not current[u].dominates(vs):
+            print("cached VSL does not match the server's; ignoring cache")
+            return
+
+    verified.update(state["verified"])
+    vsl = VSL()
+    vsl.apply_VSes(vses)
+    vsl_version = version
+    unverified.extend(vses)
+    saved_version = state["version"]
+    print("restored cached VSL version {}".format(saved_version))
+
 def pre(refresh, user):
     """
     Called before all user file system operations, right after we have obtained
     an exclusive server lock.
     """
+    global vsl, vsl_version
+    if len(pending) != 0 or (vsl is not None and len(vsl.dirty) != 0):
+        # the previous operation never pushed its changes, so our view no
+        # longer matches the server's
+        _reset()
 
-    # Firt retrieve the VSL from the server
-    global vsl
-    vsl = server.retrieve_VSL()
+    # First retrieve the VS's that changed since we last looked
+    version, changed = server.retrieve_VSL(vsl_version)
+    if version < vsl_version:
+        raise ValueError("server rolled back VSL from version {} to {}".format(vsl_version, version))
 
-    if vsl == None: #or raw_vsl == {}:
-        # We're the first user to edit the fs
-        # Need to create the VS
+    vses = _decode_VSes(changed)
+
+    if vsl is None:
         vsl = VSL()
-        secfs.fs.root_i = I(user, inumber = 0)
-        return
+    vsl.apply_VSes(vses)
+    vsl_version = version
 
-    # decode vsl and get to sensible format
-    vsl = base64.b64decode(vsl["data"])
-    vsl = pickle.loads(vsl)
+    # The share owner's key is always known, so their VS's (which lead to
+    # /.users and /.groups) are verified before anything is loaded. Everyone
+    # else's are verified once the user map has been refreshed.
+    unverified.extend(vses)
+    verify(False)
 
-    # Load user I-tables into current i-tables list
-    global current_itables
-    for user in vsl.vsl.keys():
-        vs = vsl.fetch_VS(user)
-        current_itables[user] = Itable.load(vs.ihandle)
+    if len(vsl.vsl) == 0:
+        # We're the first user to edit the fs
+        secfs.fs.root_i = I(user, inumber = 0)
+        return
 
-    # Load group I-tables into current i-tables list
+    # Load user and group I-tables whose handles changed into the current
+    # i-tables list
     handles = vsl.find_group_versions()
-    for g in handles:
-        current_itables[g] = Itable.load(handles[g])
+    for u, vs in vsl.vsl.items():
+        handles[u] = vs.ihandle
+    for p, ihandle in handles.items():
+        if loaded.get(p) != ihandle:
+            current_itables[p] = Itable.load(ihandle)
+            loaded[p] = ihandle
 
     if refresh != None:
         # refresh usermap and groupmap
         refresh()
+        verify(True)
+        save()
 
 def post(push_vs):
     if not push_vs:
@@ -66,10 +228,178 @@ def post(push_vs):
         # you will probably want to leave this here and
         # put your post() code instead of "pass" below.
         return
-    
-    global vsl
-    pickled = pickle.dumps(vsl)
-    server.update_VSL(pickled)
+
+    global vsl_version
+    if vsl is None:
+        # pre() failed, and our view has already been thrown away
+        return
+    commit()
+    changes = vsl.changes()
+    if len(changes) != 0:
+        vsl_version = server.update_VSL(changes)
+        save()
+
+def commit():
+    """
+    Stores every itable modified since the last commit, uploads all blocks
+    stored in the meantime, and then signs a single new VS for each user that
+    made modifications, covering all the principals they modified.
+    """
+    for mod_as, principals in pending.items():
+        group_ihandles = {}
+        for p in principals:
+            if p.is_group():
+                group_ihandles[p] = current_itables[p].store()
+                loaded[p] = group_ihandles[p]
+
+        # only the nodes on the paths to modified entries are stored again
+        ihandle = current_itables[mod_as].store()
+        loaded[mod_as] = ihandle
+        vsl.update_list(mod_as, principals, ihandle, group_ihandles)
+        # there is no need to check our own signature
+        verified[mod_as] = _digest(vsl.vsl[mod_as])
+    pending.clear()
+
+    # the VS's must not reference blocks the server does not yet have
+    secfs.store.block.flush()
+
+# Itables are stored as radix trees of blocks keyed by inumber. Every node holds
+# up to ITABLE_FANOUT slots: leaves map inumbers to itable entries, and inner
+# nodes hold the hashes of their children. Changing an entry only rewrites the
+# nodes on the path from its leaf up to the root, and looking one up only
+# fetches the nodes along that path. A principal's ihandle is the hash of the
+# root node of its itable.
+ITABLE_FANOUT = 256
+
+# the size of a raw SHA-224 block hash
+DIGEST_SIZE = 28
+_NO_DIGEST = bytes(DIGEST_SIZE)
+
+class ItableNode:
+    """
+    A single node of an itable tree. Nodes at depth 0 are leaves. Children
+    are only loaded once a lookup passes through them, and a node's hash is
+    None if it has been modified since it was last stored.
+
+    Inner nodes, and the leaves of user itables, only ever hold block hashes.
+    Such nodes keep their slots as raw digests packed into a single bytearray,
+    with an all-zero digest marking an empty slot. The bytearray only extends
+    up to the highest slot in use, so that small itables stay small. A node
+    that is given any other value (i.e. a group itable leaf, which maps to
+    is) switches to keeping its slots in a dict.
+    """
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.digests = bytearray()
+        self.entries = None # slot => itable entry, if not packed
+        self.children = {} # slot => loaded child ItableNode
+        self.hash = None
+
+    def load(nhash):
+        b = secfs.store.block.load(nhash)
+        if b == None:
+            return None
+
+        n = ItableNode()
+        n.depth, slots = pickle.loads(b)
+        n.unpack(slots)
+        n.hash = nhash
+        return n
+
+    def pack(self):
+        """
+        Returns this node's slots in the form they are stored in.
+        """
+        if self.entries is not None:
+            return self.entries
+        return bytes(self.digests)
+
+    def unpack(self, slots):
+        if isinstance(slots, dict):
+            self.digests = None
+            self.entries = slots
+        else:
+            self.digests = bytearray(slots)
+            self.entries = None
+
+    def bytes(self):
+        return pickle.dumps((self.depth, self.pack()))
+
+    def get(self, slot):
+        """
+        Returns the value in the given slot, or None if it is empty.
+        """
+        if self.entries is not None:
+            return self.entries.get(slot)
+
+        d = self.digests[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE]
+        if len(d) == 0 or d == _NO_DIGEST:
+            return None
+        return d.hex()
+
+    def put(self, slot, v):
+        """
+        Sets the value in the given slot.
+        """
+        if self.entries is None:
+            d = None
+            if isinstance(v, str) and len(v) == 2 * DIGEST_SIZE:
+                try:
+                    d = bytes.fromhex(v)
+                except ValueError:
+                    pass
+            if d is not None:
+                end = (slot + 1) * DIGEST_SIZE
+                if len(self.digests) < end:
+                    self.digests.extend(bytes(end - len(self.digests)))
+                self.digests[end - DIGEST_SIZE:end] = d
+                return
+
+            # not a block hash, so we can no longer pack this node
+            self.entries = dict(self.items())
+            self.digests = None
+        self.entries[slot] = v
+
+    def items(self):
+        """
+        Yields a (slot, value) pair for every non-empty slot.
+        """
+        if self.entries is not None:
+            yield from self.entries.items()
+            return
+        for slot in range(len(self.digests) // DIGEST_SIZE):
+            v = self.get(slot)
+            if v is not None:
+                yield slot, v
+
+    def child(self, slot):
+        """
+        Returns the child node in the given slot, loading it if necessary, or
+        None if there is no such child.
+        """
+        if slot in self.children:
+            return self.children[slot]
+        chash = self.get(slot)
+        if chash == None:
+            return None
+
+        c = ItableNode.load(chash)
+        if c == None:
+            raise LookupError("itable node {} is missing".format(chash))
+        self.children[slot] = c
+        return c
+
+    def store(self):
+        """
+        Stores this node and every modified node below it, and returns the
+        node's hash.
+        """
+        if self.hash is None:
+            for slot, c in self.children.items():
+                if c.hash is None:
+                    self.put(slot, c.store())
+            self.hash = secfs.store.block.store(self.bytes())
+        return self.hash
 
 class Itable:
     """
@@ -78,7 +408,9 @@ class Itable:
     groups.
     """
     def __init__(self):
-        self.mapping = {}
+        # the root node is stored together with the next free inumber
+        self.root = ItableNode()
+        self.next = 0
 
     def load(ihandle):
         b = secfs.store.block.load(ihandle)
@@ -86,11 +418,79 @@ class Itable:
             return None
 
         t = Itable()
-        t.mapping = pickle.loads(b)
+        data = pickle.loads(b)
+        if isinstance(data, dict):
+            # itable stored as a single mapping before itables were trees
+            for n, v in data.items():
+                t.set(n, v)
+            return t
+
+        t.next, t.root.depth, slots = data
+        t.root.unpack(slots)
+        t.root.hash = ihandle
         return t
 
     def bytes(self):
-        return pickle.dumps(self.mapping)
+        return pickle.dumps((self.next, self.root.depth, self.root.pack()))
+
+    def _capacity(self):
+        return ITABLE_FANOUT ** (self.root.depth + 1)
+
+    def get(self, n):
+        """
+        Returns the entry for inumber n, or None if n is not mapped.
+        """
+        if n < 0 or n >= self._capacity():
+            return None
+
+        node = self.root
+        for depth in range(node.depth, 0, -1):
+            node = node.child((n // ITABLE_FANOUT ** depth) % ITABLE_FANOUT)
+            if node == None:
+                return None
+        return node.get(n % ITABLE_FANOUT)
+
+    def set(self, n, v):
+        """
+        Maps inumber n to v, marking every node on the path to it modified.
+        """
+        while n >= self._capacity():
+            # grow the tree by putting a new root above the current one. the
+            # old root must be stored again, as a plain node this time.
+            root = ItableNode(self.root.depth + 1)
+            root.children[0] = self.root
+            self.root.hash = None
+            self.root = root
+
+        node = self.root
+        node.hash = None
+        for depth in range(node.depth, 0, -1):
+            slot = (n // ITABLE_FANOUT ** depth) % ITABLE_FANOUT
+            c = node.child(slot)
+            if c == None:
+                c = ItableNode(depth - 1)
+                node.children[slot] = c
+            c.hash = None
+            node = c
+        node.put(n % ITABLE_FANOUT, v)
+        self.next = max(self.next, n + 1)
+
+    def allocate(self):
+        """
+        Returns a fresh inumber for a new entry.
+        """
+        return self.next
+
+    def store(self):
+        """
+        Stores every modified node of this itable, and returns its ihandle.
+        """
+        if self.root.hash is None:
+            for slot, c in self.root.children.items():
+                if c.hash is None:
+                    self.root.put(slot, c.store())
+            self.root.hash = secfs.store.block.store(self.bytes())
+        return self.root.hash
 
 def resolve(i, resolve_groups = True):
     """
@@ -122,21 +522,22 @@ def resolve(i, resolve_groups = True):
 
     t = current_itables[principal]
 
-    if i.n not in t.mapping:
+    v = t.get(i.n)
+    if v == None:
         raise LookupError("principal {} does not have i {}".format(principal, i))
 
     # santity checks
-    if principal.is_group() and not isinstance(t.mapping[i.n], I):
+    if principal.is_group() and not isinstance(v, I):
         raise TypeError("looking up group i, but did not get indirection ihash")
-    if principal.is_user() and isinstance(t.mapping[i.n], I):
+    if principal.is_user() and isinstance(v, I):
         raise TypeError("looking up user i, but got indirection ihash")
 
-    if isinstance(t.mapping[i.n], I) and resolve_groups:
+    if isinstance(v, I) and resolve_groups:
         # we're looking up a group i
         # follow the indirection
-        return resolve(t.mapping[i.n])
+        return resolve(v)
 
-    return t.mapping[i.n]
+    return v
 
 def modmap(mod_as, i, ihash):
     """
@@ -178,7 +579,6 @@ def modmap(mod_as, i, ihash):
             else:
                 # Allocate a new entry for mod_as, and continue as though ihash
                 # was that new i.
-                # XXX: kind of unnecessary to send two VS for this
                 _ihash = ihash
                 ihash = modmap(mod_as, I(mod_as), ihash)
                 print("mapping", i, "to", ihash, "which again points to", _ihash)
@@ -196,31 +596,23 @@ def modmap(mod_as, i, ihash):
             # user did not have an itable, but an inumber was given
             raise ReferenceError("itable not available")
         t = Itable()
-        print("no current list for principal", i.p, "; creating empty table", t.mapping)
+        print("no current list for principal", i.p, "; creating empty table")
     else:
         t = current_itables[i.p]
 
     # look up (or allocate) the inumber for the i we want to modify
     if not i.allocated():
-        inumber = 0
-        while inumber in t.mapping:
-            inumber += 1
-        i.allocate(inumber)
+        i.allocate(t.allocate())
     else:
-        if i.n not in t.mapping:
+        if t.get(i.n) == None:
             raise IndexError("invalid inumber")
 
     # modify the entry, and store back the updated itable
     if i.p.is_group():
-        print("mapping", i.n, "for group", i.p, "into", t.mapping)
-    t.mapping[i.n] = ihash # for groups, ihash is an i
+        print("mapping", i.n, "for group", i.p)
+    t.set(i.n, ihash) # for groups, ihash is an i
     current_itables[i.p] = t
 
-    itable_hash = secfs.store.block.store(t.bytes())
-    if not i.p.is_group():
-        global vsl
-        vsl.update_list(i.p, i.p, itable_hash)
-    else:
-        user_itable_hash = secfs.store.block.store(current_itables[mod_as].bytes())
-        vsl.update_list(mod_as, i.p, user_itable_hash, group_ihandle=itable_hash)
+    # the itable is stored, and the change signed, by commit()
+    pending.setdefault(mod_as, set()).add(i.p)
     return i
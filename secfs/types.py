@@ -1,4 +1,5 @@
 class Principal:
+    __slots__ = ()
     @property
     def id(self):
         return -1
@@ -7,12 +8,27 @@ class Principal:
     def is_group(self):
         return False
 
+# Principals are interned: there is only ever one User or Group object for each
+# id, so they take no extra memory wherever they are referenced, and compare by
+# identity in the common case.
 class User(Principal):
-    def __init__(self, uid):
+    __slots__ = ("_uid",)
+    _interned = {}
+    def __new__(cls, uid=None):
+        if uid is None:
+            # unpickling a User pickled by state; __setstate__ sets the uid
+            return super().__new__(cls)
         if not isinstance(uid, int):
             raise TypeError("id {} is not an int, is a {}".format(uid, type(uid)))
 
-        self._uid = uid
+        u = User._interned.get(uid)
+        if u is None:
+            u = super().__new__(cls)
+            u._uid = uid
+            User._interned[uid] = u
+        return u
+    def __reduce__(self):
+        return (User, (self._uid,))
     def __getstate__(self):
         return (self._uid, False)
     def __setstate__(self, state):
@@ -23,18 +39,30 @@ class User(Principal):
     def is_user(self):
         return True
     def __eq__(self, other):
-        return isinstance(other, User) and self._uid == other._uid
+        return self is other or (isinstance(other, User) and self._uid == other._uid)
     def __str__(self):
         return "<uid={}>".format(self._uid)
     def __hash__(self):
         return hash(self._uid)
 
 class Group(Principal):
-    def __init__(self, gid):
+    __slots__ = ("_gid",)
+    _interned = {}
+    def __new__(cls, gid=None):
+        if gid is None:
+            # unpickling a Group pickled by state; __setstate__ sets the gid
+            return super().__new__(cls)
         if not isinstance(gid, int):
             raise TypeError("id {} is not an int, is a {}".format(gid, type(gid)))
 
-        self._gid = gid
+        g = Group._interned.get(gid)
+        if g is None:
+            g = super().__new__(cls)
+            g._gid = gid
+            Group._interned[gid] = g
+        return g
+    def __reduce__(self):
+        return (Group, (self._gid,))
     def __getstate__(self):
         return (self._gid, True)
     def __setstate__(self, state):
@@ -45,13 +73,14 @@ class Group(Principal):
     def is_group(self):
         return True
     def __eq__(self, other):
-        return isinstance(other, Group) and self._gid == other._gid
+        return self is other or (isinstance(other, Group) and self._gid == other._gid)
     def __str__(self):
         return "<gid={}>".format(self._gid)
     def __hash__(self):
         return hash(self._gid)
 
 class I:
+    __slots__ = ("_p", "_n", "_hash")
     def __init__(self, principal, inumber=None):
         if not isinstance(principal, Principal):
             raise TypeError("{} is not a Principal, is a {}".format(principal, type(principal)))
@@ -60,11 +89,13 @@ class I:
 
         self._p = principal
         self._n = inumber
+        self._hash = None
     def __getstate__(self):
         return (self._p, self._n)
     def __setstate__(self, state):
         self._p = state[0]
         self._n = state[1]
+        self._hash = None
     @property
     def p(self):
         return self._p
@@ -84,9 +115,12 @@ class I:
             return "({}, {})".format(self._p, self._n)
         return "({}, <unallocated>)".format(self._p)
     def __hash__(self):
-        if not self.allocated():
-            raise TypeError("cannot hash unallocated i {}".format(self))
-        return hash((self._p, self._n))
+        # the hash is computed once; an i cannot change after allocation
+        if self._hash is None:
+            if not self.allocated():
+                raise TypeError("cannot hash unallocated i {}".format(self))
+            self._hash = hash((self._p, self._n))
+        return self._hash
 
 class VS:
     def __init__(self, user=None):
@@ -105,12 +139,72 @@ class VS:
 
         #Signature of user
         self.signature = None
-    
+
+    def signed_bytes(self):
+        """
+        Returns the canonical serialization of this VS that its signature
+        covers (i.e. everything but the signature itself).
+        """
+        import pickle
+        return pickle.dumps((
+            self.ihandle,
+            str(self.user),
+            sorted((str(p), v) for p, v in self.v_vect.items()),
+            sorted((str(g), h) for g, h in self.group_ihandle.items()),
+        ))
+
+    def dominates(self, other):
+        """
+        Returns True if this VS's version vector is element-wise greater than
+        or equal to that of the given VS, i.e. if this VS has seen every
+        change the other VS has seen.
+        """
+        mine = self.v_vect
+        for p, v in other.v_vect.items():
+            if mine.get(p, 0) < v:
+                return False
+        return True
+
 
 class VSL:
-    def __init__(self, p_vsl={}):
-        # List of VS's keyed by principal
-        self.vsl = p_vsl
+    def __init__(self, p_vsl=None):
+        # List of VS's keyed by user
+        self.vsl = {}
+
+        # The element-wise maximum of the version vectors of all VS's in the
+        # list, and the group i-handle belonging to each group's maximum
+        # version. These are maintained incrementally as VS's are added, so
+        # that a new VS never has to look at every other VS.
+        self.merged = {}
+        self.group_handles = {}
+
+        # users whose VS's were changed locally, but not yet pushed
+        self.dirty = set()
+
+        if p_vsl is not None:
+            for p, vs in p_vsl.items():
+                self.vsl[p] = vs
+                self._merge(vs)
+
+    def __getstate__(self):
+        # the merged vector is derived from the VS's, so it is not shipped
+        return {"vsl": self.vsl}
+    def __setstate__(self, state):
+        self.__init__(state["vsl"])
+
+    def _merge(self, vs):
+        """
+        Folds the given VS into the merged version vector, and returns the
+        principals whose merged version it raised.
+        """
+        raised = []
+        for p, v in vs.v_vect.items():
+            if p not in self.merged or v > self.merged[p]:
+                self.merged[p] = v
+                raised.append(p)
+                if p in vs.group_ihandle:
+                    self.group_handles[p] = vs.group_ihandle[p]
+        return raised
 
     # Fetch the current VS for a specified user
     def fetch_VS(self, principal):
@@ -118,17 +212,58 @@ class VSL:
 
     def update_VS(self, principal, vs):
         # sign VS before updating
-        import pickle
         key = secfs.crypto.keys[vs.user]
-        vs.signature = secfs.crypto.sign(key, pickle.dumps(vs))
+        vs.signature = secfs.crypto.sign(key, vs.signed_bytes())
         # check for prev <= current
-        old_vs = VS()
-        if principal in self.vsl.keys():
-            old_vs = self.vsl[principal]
-        old_total = sum(old_vs.v_vect.values())
-        new_total = sum(vs.v_vect.values())
-        assert new_total >= old_total
+        if principal in self.vsl:
+            assert vs.dominates(self.vsl[principal])
         self.vsl[principal] = vs
+        self._merge(vs)
+        self.dirty.add(principal)
+
+    def apply_VSes(self, vses):
+        """
+        Adds VS's fetched from the server to the list. Every VS must dominate
+        the user's previous VS, and, as all changes are serialized, the most
+        recent one must dominate every VS in the list.
+
+        A user's own version only ever grows in their own VS's, so every
+        user's VS must also carry the highest version of that user seen in any
+        VS. Otherwise, the server is withholding the user's latest VS. Only the
+        users whose VS or merged version changed need to be checked.
+        """
+        if len(vses) == 0:
+            return
+
+        changed = set()
+        for vs in vses:
+            if vs.user in self.vsl and not vs.dominates(self.vsl[vs.user]):
+                raise ValueError("VS for {} rolls back its previous VS".format(vs.user))
+            self.vsl[vs.user] = vs
+            changed.add(vs.user)
+            changed.update(self._merge(vs))
+
+        merged = VS()
+        merged.v_vect = self.merged
+        if not any(vs.dominates(merged) for vs in vses):
+            raise ValueError("VSL contains VS's that are not totally ordered")
+
+        for u in changed:
+            if not u.is_user():
+                continue
+            have = self.vsl[u].v_vect.get(u, 0) if u in self.vsl else 0
+            if have != self.merged.get(u, 0):
+                raise ValueError("VSL lacks the latest VS for {}".format(u))
+
+    def changes(self):
+        """
+        Returns the pickled VS's that changed locally since the last call,
+        keyed by user name.
+        """
+        import pickle
+        changed = {str(p): pickle.dumps(self.vsl[p]) for p in self.dirty}
+        self.dirty = set()
+        return changed
 
     ## TODO figure out if we still need this function?
     def serialize(self):
@@ -138,88 +273,141 @@ class VSL:
             self.vsl[key] = ser
 
     def find_group_versions(self):
-        ret_versions = {}
-        ret_handles = {}
-        for vs in self.vsl.values():
-            for g in vs.group_ihandle:
-                g_version = vs.v_vect[g]
-                g_handle = vs.group_ihandle[g]
-
-                if g not in ret_versions or g_version > ret_versions[g]:
-                    # THis is a more current version than the one we have stored
-                    ret_versions[g] = g_version
-                    ret_handles[g] = g_handle
-        return ret_handles
-
-    def update_list(self, mod_as, principal, mod_as_ihandle, group_ihandle=None):
-        new_VS = VS() # a new VS to store into
-
-        # Check to see if the principal is a group or user
-        group = False
-        if principal.is_group():
-            group = True
-
-        # If we don't have an entry for the mod_as, add one
-        if mod_as not in self.vsl.keys():
-            self.vsl[mod_as] = VS()
-
-        # Find the most updated version list across all VS's by finding the VS with the
-        # most recent version of each i-handle
-        highest = -1
-        best_vect = None
-
-        for p in self.vsl.keys():
-            vect = self.vsl[p]
-
-            #sum the version numbers to find the aggregate amount of changes encapsulated
-            # in the version vector
-            total = sum(vect.v_vect.values())
-
-            if total > highest:
-                highest = total
-                best_vect = vect.v_vect
+        """
+        Returns the most recent i-handle of every group's itable.
+        """
+        return dict(self.group_handles)
 
+    def update_list(self, mod_as, principals, mod_as_ihandle, group_ihandles=None):
+        """
+        Adds a new VS for mod_as, recording that it has modified the itables
+        of the given principals. mod_as_ihandle is the new ihandle of mod_as's
+        itable, and group_ihandles holds the new ihandles of any groups among
+        the principals.
+        """
+        if group_ihandles is None:
+            group_ihandles = {}
 
+        new_VS = VS(mod_as) # a new VS to store into
         new_VS.ihandle = mod_as_ihandle
-        new_VS.group_ihandle = self.vsl[mod_as].group_ihandle
-        new_vector = best_vect
 
-        # Check if this is our first time modifying this principal's itable
-        if principal not in new_vector:
-            new_vector[principal] = 0
-        new_vector[principal] += 1
+        # The new VS must dominate every VS in the list, so it starts out from
+        # their merged version vector, and carries the group i-handles that
+        # go with those versions.
+        new_VS.v_vect = dict(self.merged)
+        new_VS.group_ihandle = dict(self.group_handles)
 
-        if group:
-            new_VS.group_ihandle[principal] = group_ihandle
+        for principal in principals:
+            # Check if this is our first time modifying this principal's itable
+            new_VS.v_vect[principal] = new_VS.v_vect.get(principal, 0) + 1
 
-        new_VS.v_vect = new_vector
-        new_VS.user = mod_as
+            if principal.is_group():
+                new_VS.group_ihandle[principal] = group_ihandles[principal]
 
-        self.update_VS(principal, new_VS)
+        # VS's are always kept by the user that made the change
+        self.update_VS(mod_as, new_VS)
 
 ### necessary packages for crypto-related functionality for
 ### this symmetric key store class
-from cryptography.fernet import Fernet
 import secfs.crypto
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
-from cryptography.hazmat.backends import default_backend
 
 class SymmetricKeyStore:
-    def __init__(self, users, groups):
+    """
+    The SymmetricKeyStore holds the symmetric keys used to encrypt file
+    contents: one per user, and one per group. Each key is wrapped with the
+    public key of every user allowed to use it. The server keeps one entry per
+    such (principal, user) pair, so adding a user or a group member, or
+    rotating a single group's key, only re-wraps and uploads the entries that
+    changed. Changed entries are collected until updates() is called.
+    """
+    def __init__(self, users=None, groups=None):
         """
         users: a dict mapping users -> public keys
         groups: a dict mapping groups -> list of users
         """
-        # deserialize public key from PEM encoded data
-        for u in users:
-            users[u] = load_pem_public_key(users[u], backend=default_backend())
-
-        # assign users keys
-        self.users = {user: secfs.crypto.encrypt_asym(users[u], Fernet.generate_key()) for user in users}
-
-        # assign groups keys
+        if users is None:
+            users = {}
+        if groups is None:
+            groups = {}
+
+        # user => wrapped key
+        self.users = {}
+        # group => user => wrapped key
         self.groups = {}
+        # (principal, user) pairs whose entries changed since updates()
+        self.dirty = set()
+
+        for user in users:
+            self.add_user(user, users[user])
         for group in groups:
-            group_key = Fernet.generate_key()
-            self.groups[group] = {user: secfs.crypto.encrypt_asym(users[user], group_key)
-                                  for user in groups[group]}
+            self.rotate_group(group, {user: users[user] for user in groups[group]})
+
+    def entry(principal, user):
+        """
+        Returns the name of the server entry holding the key for files owned
+        by principal, as wrapped for user.
+        """
+        return "{}/{}".format(principal, user)
+
+    def _wrap(pubkey, key):
+        # deserialize public key from PEM encoded data if necessary
+        if isinstance(pubkey, bytes):
+            pubkey = secfs.crypto.load_public_key(pubkey)
+        return secfs.crypto.encrypt_asym(pubkey, key)
+
+    def add_user(self, user, pubkey):
+        """
+        Assigns a fresh key to the given user.
+        """
+        self.users[user] = SymmetricKeyStore._wrap(pubkey, secfs.crypto.generate_symmetric_key())
+        self.dirty.add((user, user))
+
+    def add_member(self, group, user, pubkey, group_key):
+        """
+        Gives the given user access to the group's current key. group_key is
+        that key unwrapped, as returned by secfs.keys.key_for for an existing
+        member.
+        """
+        self.groups.setdefault(group, {})[user] = SymmetricKeyStore._wrap(pubkey, group_key)
+        self.dirty.add((group, user))
+
+    def remove_member(self, group, user):
+        """
+        Removes the given user's copy of the group's key. The group's key
+        should then be rotated, as the user may have kept it.
+        """
+        self.groups.get(group, {}).pop(user, None)
+        self.dirty.add((group, user))
+
+    def rotate_group(self, group, members):
+        """
+        Assigns a fresh key to the given group, and wraps it for each of the
+        given members (a dict mapping users -> public keys). The new key is
+        returned. Users this store holds the group's key for that are not
+        among the members are removed. Entries on the server that this store
+        does not know about are left alone; secfs.keys.rotate_group also
+        removes those.
+        """
+        group_key = secfs.crypto.generate_symmetric_key()
+        for user in list(self.groups.get(group, {})):
+            if user not in members:
+                self.remove_member(group, user)
+        self.groups[group] = {}
+        for user in members:
+            self.add_member(group, user, members[user], group_key)
+        return group_key
+
+    def updates(self):
+        """
+        Returns the server entries that changed since the last call, as a dict
+        mapping entry names to wrapped keys, or to None for removed entries.
+        """
+        changed = {}
+        for principal, user in self.dirty:
+            if principal.is_user():
+                wrapped = self.users.get(user)
+            else:
+                wrapped = self.groups.get(principal, {}).get(user)
+            changed[SymmetricKeyStore.entry(principal, user)] = wrapped
+        self.dirty = set()
+        return changed
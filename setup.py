@@ -14,7 +14,7 @@ setup(
     url='https://github.com/mit-pdos/6.858-secfs',
     packages=['secfs', 'secfs.store'],
     install_requires=['llfuse', 'Pyro4', 'serpent', 'cryptography'],
-    scripts=['bin/secfs-server', 'bin/secfs-fuse'],
+    scripts=['bin/secfs-server', 'bin/secfs-fuse', 'bin/secfs-rebalance', 'bin/secfs-fsck'],
     license='MIT',
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
@@ -5,6 +5,8 @@ mntat="$rundir/mnt"
 mkdir "$mntat"
 server=0 # PID of server, set by includer
 uri="" # set by includer
+shards="" # PIDs of shard servers, set by shard
+shard_uri="" # URI of the last shard started, set by shard
 
 # shellcheck disable=SC2034
 uxsock="$rundir/sock" # read by includer
@@ -25,15 +27,16 @@ WARN="[ ${YELLOW}INFO${NORMAL} ]"
 
 fuse=0
 nxt_fname="primary-client"
+client_env="" # extra VAR=value settings for the next clients, set by includer
 client() {
 	rm -f "$nxt_fname.log" 2>/dev/null
 	if [ $# -eq 0 ]; then
-		# shellcheck disable=SC2024
-		sudo PYTHONUNBUFFERED=1 venv/bin/secfs-fuse "$uri" "$mntat" "root.pub" "user-0-key.pem" "user-$(id -u)-key.pem" "user-666-key.pem" > "$nxt_fname.log" 2> "$nxt_fname.err" &
+		# shellcheck disable=SC2024,SC2086
+		sudo PYTHONUNBUFFERED=1 $client_env venv/bin/secfs-fuse "$uri" "$mntat" "root.pub" "user-0-key.pem" "user-$(id -u)-key.pem" "user-666-key.pem" > "$nxt_fname.log" 2> "$nxt_fname.err" &
 		fuse=$!
 	else
-		# shellcheck disable=SC2024
-		sudo PYTHONUNBUFFERED=1 venv/bin/secfs-fuse "$uri" "$mntat" "$@" > "$nxt_fname.log" 2> "$nxt_fname.err" &
+		# shellcheck disable=SC2024,SC2086
+		sudo PYTHONUNBUFFERED=1 $client_env venv/bin/secfs-fuse "$uri" "$mntat" "$@" > "$nxt_fname.log" 2> "$nxt_fname.err" &
 		fuse=$!
 	fi
 	info "client started; waiting for init"
@@ -96,6 +99,10 @@ cleanup() {
 	client_cleanup
 	kill "$server" 2>/dev/null
 	wait "$server" 2>/dev/null
+	for s in $shards; do
+		kill "$s" 2>/dev/null
+		wait "$s" 2>/dev/null
+	done
 
 	rm -rf "$rundir"
 
@@ -104,6 +111,21 @@ cleanup() {
 	fi
 }
 
+# start a block server (see bin/secfs-rebalance) with the same flags as the
+# main server ($server_flags, set by includer), and wait for its URI
+shard() {
+	# shellcheck disable=SC2086
+	env PYTHONUNBUFFERED=1 venv/bin/secfs-server $server_flags --shard "$rundir/$1.sock" > "$1.log" 2> "$1.err" &
+	shards="$shards $!"
+
+	sync
+	while ! grep -P "^uri =" "$1.log" > /dev/null; do
+		sleep .2
+	done
+	shard_uri=$(grep "^uri =" "$1.log" | awk '{print $3}')
+	info "started shard %s at %s" "$1" "$shard_uri"
+}
+
 tests=0
 passed=0
 
@@ -316,6 +338,31 @@ expect() {
 	fi
 }
 
+# run a command outside of the file system, logging to $1.log, and check that
+# it exits with status $2 (or with any non-zero status if $2 is "fail")
+status() {
+	tests="$(echo "$tests+1" | bc -l)"
+
+	local name="$1"
+	local want="$2"
+	shift 2
+
+	o=$(printf "${DOTS}: run %s\r" "$*")
+	local lastlen=${#o}
+	printf "%s" "$o"
+	"$@" >> "$name.log" 2>> "$name.err"
+	local ex=$?
+
+	printf "%${lastlen}s\r" " " # clear previous message
+	if [ "$want" = "fail" ] && [ $ex -ne 0 ] || [ "$want" = "$ex" ]; then
+		printf "${PASS}: (%s) exited with %d\n" "$*" "$ex"
+		passed="$(echo "$passed+1" | bc -l)"
+		return 0
+	fi
+	printf "${FAIL}: (%s) exited with %d, see %s.log\n" "$*" "$ex" "$name"
+	return 1
+}
+
 server_mem() {
 	tests="$(echo "$tests+1" | bc -l)"
 
@@ -1,11 +1,24 @@
 #!/bin/sh
 
 ## added extra stuff
-rm *.err *.log
+rm -f *.err *.log
 
 base=$(dirname "$0")
 cd "$base" || exit 1
 
+# With --async, the servers use SecFS's own RPC transport (see secfs/rpc.py)
+# rather than Pyro4. Without it, the tests are run again with it once they are
+# done. Each run's logs are moved to its own directory (logdir) when it ends,
+# and the script fails if any test in either run fails.
+server_flags=""
+logdir="logs-pyro4"
+if [ "$1" = "--async" ]; then
+	server_flags="--async"
+	logdir="logs-async"
+else
+	rm -rf logs-pyro4 logs-async
+fi
+
 # we're going to need sudo
 sudo date > /dev/null
 
@@ -25,9 +38,11 @@ pip3 install --upgrade -e . > pip.log
 # shellcheck source=test-lib.sh
 . "$base/test-lib.sh"
 
-# start a clean server for testing
+# start a clean server for testing. it collects garbage every few seconds, and
+# only keeps unreachable blocks around for a couple of seconds, so that the
+# garbage collector runs (and frees blocks) while the tests run
 info "starting server"
-env PYTHONUNBUFFERED=1 venv/bin/secfs-server "$uxsock" > server.log 2> server.err &
+env PYTHONUNBUFFERED=1 SECFS_GC_INTERVAL=3 SECFS_GC_RETENTION=2 venv/bin/secfs-server $server_flags "$uxsock" > server.log 2> server.err &
 server=$!
 
 # wait for server to start and announce its URI
@@ -35,7 +50,7 @@ sync
 while ! grep -P "^uri =" server.log > /dev/null; do
 	sleep .2
 done
-uri=$(grep "uri = PYRO:secfs" server.log | awk '{print $3}')
+uri=$(grep "^uri =" server.log | awk '{print $3}')
 
 # start primary client and connect it to the server
 info "connecting to server at %s" "$uri"
@@ -202,6 +217,67 @@ popc
 expect "cat shared/third-client-file" '^b\nb$' || fail "couldn't read back file created by user in separate client"
 
 
+section "Sharding"
+shard "shard-0"
+shard0="$shard_uri"
+shard "shard-1"
+shard1="$shard_uri"
+status "rebalance" 0 venv/bin/secfs-rebalance "$uri" "$shard0" "$shard1" || fail "couldn't spread blocks over 2 shards"
+expect "cat shared/third-client-file" '^b\nb$' || fail "couldn't read back file after sharding"
+expect "cat shared/user-only/file" '^c\nc$' || fail "couldn't read back nested file after sharding"
+expect "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny$' || fail "couldn't read back encrypted file after sharding"
+expect "cat group-secret" '^dociousaliexpilisticfragicalirupes\nz$' || fail "couldn't read back group encrypted file after sharding"
+expect "echo d | tee shared/sharded-file" "cat shared/sharded-file" '^d$' || fail "couldn't create file after sharding"
+
+
+section "Garbage collection"
+# appending replaces each file's last block and inode, and the itable nodes on
+# the way to it, leaving the old ones unreachable
+expect "echo f | tee -a shared/user-only/file" "cat shared/user-only/file" '^c\nc\nf$' || fail "couldn't append to file before collection"
+expect "echo g | sudo tee -a root-secret" "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny\ng$' || fail "couldn't append to encrypted file before collection"
+expect "echo h | sudo tee -a group-secret" "sudo cat group-secret" '^dociousaliexpilisticfragicalirupes\nz\nh$' || fail "couldn't append to group encrypted file before collection"
+
+# wait for two more collections to complete, as the first may have started
+# before the files were rewritten
+info "waiting for the server to collect garbage"
+collected=$(grep -c "^gc: freed" server.log)
+waited=0
+while [ "$(grep -c "^gc: freed" server.log)" -lt $((collected + 2)) ] && [ $waited -lt 300 ]; do
+	sleep .2
+	waited=$((waited + 1))
+done
+status "gc" 0 sh -c "grep '^gc: freed' server.log | tail -n +$((collected + 1)) | grep -q '^gc: freed [1-9]'" || fail "server didn't free the rewritten files' old blocks"
+
+expect "cat shared/user-only/file" '^c\nc\nf$' || fail "couldn't read back file after collection"
+expect "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny\ng$' || fail "couldn't read back encrypted file after collection"
+expect "cat group-secret" '^dociousaliexpilisticfragicalirupes\nz\nh$' || fail "couldn't read back group encrypted file after collection"
+expect "cat shared/sharded-file" '^d$' || fail "couldn't read back sharded file after collection"
+expect "cat shared/third-client-file" '^b\nb$' || fail "couldn't read back file from other client after collection"
+expect "sudo cat root-only/file" '^a\na$' || fail "couldn't read back root file after collection"
+expect "cat .users" '.+' || fail ".users couldn't be read after collection"
+
+
+section "Remounting with an on-disk cache"
+# the first mount fills the cache, and writes the VSL it validated to it when
+# unmounted; the second must pick that VSL up again
+client_env="SECFS_CACHE_DIR=$PWD/$rundir/cache"
+pushc "cached-client"
+client
+expect "cat shared/user-only/file" '^c\nc\nf$' || fail "couldn't read file through cache"
+expect "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny\ng$' || fail "couldn't read encrypted file through cache"
+popc
+pushc "remounted-client"
+client
+status "remount" 0 grep -q "^restored cached VSL" remounted-client.log || fail "remounted client didn't use its cached VSL"
+expect "cat shared/user-only/file" '^c\nc\nf$' || fail "couldn't read file after remounting with cache"
+expect "sudo cat root-secret" '^supercalifragilisticexpialidocious\ny\ng$' || fail "couldn't read encrypted file after remounting with cache"
+expect "cat group-secret" '^dociousaliexpilisticfragicalirupes\nz\nh$' || fail "couldn't read group encrypted file after remounting with cache"
+expect "echo i | tee shared/cached-file" "cat shared/cached-file" '^i$' || fail "couldn't create file after remounting with cache"
+popc
+client_env=""
+expect "cat shared/cached-file" '^i$' || fail "couldn't read back file created by remounted client"
+
+
 section "Manipulating as non-member"
 cant "create file in group-writeable directory as non-member" "echo b | sudo -u '#666' tee shared/muhaha"
 cant "read back file created in group-writeable directory as non-member" "sudo -u '#666' stat shared/muhaha"
@@ -223,6 +299,21 @@ cant "operate on file system with untrusted root" "stat ."
 popc
 
 
+section "Integrity check"
+# this runs before the forking attack, after which the server serves a VSL
+# whose blocks the garbage collector may already have freed, and before the
+# malicious client test, which leaves behind a VS that fsck rightly reports as
+# having a bad signature
+status "fsck" 0 venv/bin/secfs-fsck "$uri" root.pub || fail "fsck found problems in an intact file system"
+# small unencrypted blocks are stored as-is, so this names the block holding
+# the contents of shared/sharded-file
+chash=$(printf 'd\n' | sha224sum | awk '{print $1}')
+for s in "$shard0" "$shard1"; do
+	venv/bin/python -c 'import sys, secfs.rpc; secfs.rpc.connect(sys.argv[1]).delete_blocks([sys.argv[2]])' "$s" "$chash"
+done
+status "fsck" fail venv/bin/secfs-fsck "$uri" root.pub || fail "fsck didn't notice a missing block"
+
+
 section "Forking attack!"
 pushc "forked-client"
 client
@@ -275,3 +366,18 @@ cant "successfully read file modified by malicious user" "grep be-afraid shared/
 cleanup
 
 info "all tests done (passed %d/%d -- %.1f%%); cleaning up\n" "$passed" "$tests" "$(echo "100*$passed/$tests" | bc -l)"
+
+result=0
+if [ "$passed" -ne "$tests" ]; then
+	result=1
+fi
+
+mkdir -p "$logdir"
+mv -f -- *.log *.err "$logdir" 2>/dev/null
+info "logs of this run are in %s" "$logdir"
+
+if [ -z "$server_flags" ]; then
+	info "running tests again with an --async server"
+	sh "./$(basename "$0")" --async || result=1
+fi
+exit $result